@@ -1,45 +1,113 @@
+import atexit
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import os
+import queue
+import re
+import unicodedata
 from datetime import datetime, timedelta, timezone
+import google.auth
+from google.auth.credentials import TokenState
+from google.auth.transport.requests import AuthorizedSession, Request as GoogleAuthRequest
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from google.cloud import firestore
-import requests
+from google.api_core import exceptions as google_exceptions
 import json
 from dotenv import load_dotenv
 import time
-from solapi import SolapiMessageService
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from solapi.lib.authenticator import Authenticator
 from solapi.model import RequestMessage
-import base64
+from solapi.model.request.send_message_request import SendMessageRequest
+from solapi.model.response.send_message_response import SendMessageResponse
 from flask import Flask, jsonify
 import threading
-import pytz
-import uuid
-import httplib2
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:  # orjson이 설치되지 않은 환경에서는 표준 json 모듈을 사용
+    orjson = None
+
+# 환경 변수 로드 (LOG_LEVEL을 로깅 설정에 쓰므로 로깅보다 먼저 불러옵니다)
+load_dotenv()
 
 # 로깅 설정
+# 로그 레코드는 큐에 넣기만 하고, 콘솔/파일 출력은 QueueListener 스레드가 처리해
+# 폴링 스레드가 디스크 쓰기로 막히지 않도록 합니다
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler = logging.StreamHandler()  # 콘솔에 출력
+console_handler.setFormatter(log_formatter)
+file_handler = RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=3)  # 파일에도 저장
+file_handler.setFormatter(log_formatter)
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, console_handler, file_handler)
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))  # 최종 형식은 리스너 쪽 핸들러가 적용
 logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),  # 콘솔에 출력
-        logging.FileHandler('app.log')  # 파일에도 저장
-    ]
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),  # 운영에서 WARNING으로 올리면 INFO 로그는 포맷도 하지 않습니다
+    handlers=[queue_handler]
 )
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
-# 환경 변수 로드
-load_dotenv()
-
 # 환경 변수에서 설정 가져오기
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
 SHEET_NAME = os.getenv('SHEET_NAME', 'Sheet1')  # 기본값 Sheet1
-RANGE = os.getenv('RANGE', 'A2:Z')  # 기본값 A2:Z
+SHEET_LAST_COLUMN = os.getenv('SHEET_LAST_COLUMN', 'Z')  # 읽어올 마지막 컬럼
 SOLAPI_API_KEY = os.getenv('SOLAPI_API_KEY')
 SOLAPI_API_SECRET = os.getenv('SOLAPI_API_SECRET')
 SOLAPI_SENDER = os.getenv('SOLAPI_SENDER')
-RECIPIENT_PHONE_NUMBER = os.getenv('RECIPIENT_PHONE_NUMBER')
-POLLING_INTERVAL = int(os.getenv('POLLING_INTERVAL', '2'))  
+GCP_SA_KEY = os.getenv('GCP_SA_KEY')  # 서비스 계정 키 JSON (없으면 기본 자격 증명 사용)
+SHEETS_SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
+FIRESTORE_SCOPES = ['https://www.googleapis.com/auth/datastore']
+POLLING_INTERVAL = int(os.getenv('POLLING_INTERVAL', '60'))  # 푸시 트리거가 없을 때의 대체 폴링 주기(초)
+
+# SMS 본문 템플릿 ({name}, {inquiry} 자리에 값을 채워 사용)
+SMS_TEMPLATE = """[포용적 금융서비스, 프리즘지점]
+{name}님, 만사형통 프리즘 부적 이벤트에 참여해주셔서 감사합니다! 
+
+프리즘지점은 퀴어 당사자와 앨라이 보험설계사가 함께하는 보험 조직입니다. 모두를 위한 미래보장을 꿈꾸며, 금융의 경계를 넘어 연대합니다.
+
+선택해주신 프리즘지점에서, {inquiry} 문의에 반가운 마음을 전하며, 유용한 소식과 답변 안내드릴 수 있도록 곧 다시 연락드리겠습니다. 고맙습니다!
+
+프리즘지점 드림
+[보험상담 및 채용문의]
+https://litt.ly/prism.fin
+
+앞으로 소식은
+[인스타그램] 팔로우해주세요!
+www.instagram.com/prism.fin"""
+
+# 한국 표준시는 일광 절약 시간이 없으므로 고정 오프셋으로 충분합니다
+KST = timezone(timedelta(hours=9))
+MIN_TIMESTAMP = datetime.min.replace(tzinfo=timezone.utc)  # 비교용 최소 타임스탬프
+_DATETIME_RE = re.compile(
+    r'(\d{4})[-.]\s*(\d{1,2})[-.]\s*(\d{1,2})\.?\s+(?:(오전|오후)\s+)?(\d{1,2}):(\d{2})(?::(\d{2}))?'
+)
+PHONE_STRIP_TABLE = str.maketrans('', '', ''.join(chr(c) for c in range(128) if not chr(c).isdigit()))
+SMS_BATCH_SIZE = 100  # Solapi 일괄 발송 1회당 메시지 수
+SMS_SEND_WORKERS = int(os.getenv('SMS_SEND_WORKERS', '16'))  # 동시 발송 요청 수
+SHEETS_API_URL = 'https://sheets.googleapis.com/v4/spreadsheets'
+SHEETS_TIMEOUT = 10  # Sheets API 요청 타임아웃(초)
+SHEETS_MAX_RETRIES = 5
+SOLAPI_SEND_URL = 'https://api.solapi.com/messages/v4/send-many/detail'
+SOLAPI_TIMEOUT = 10  # Solapi 요청 타임아웃(초)
+SOLAPI_MAX_ATTEMPTS = 3
+# 처리되지 않은 것이 확실한 응답만 재시도합니다.
+# 502/504는 Solapi가 이미 접수했을 수 있어 중복 발송을 막기 위해 재시도하지 않습니다.
+SOLAPI_RETRYABLE_STATUSES = (429, 503)
+FIRESTORE_BATCH_LIMIT = 500  # Firestore 배치 쓰기 1회당 최대 작업 수
+FIRESTORE_COMMIT_WORKERS = int(os.getenv('FIRESTORE_COMMIT_WORKERS', '10'))  # 병렬 커밋 스레드 수
+FIRESTORE_COMMIT_MAX_ATTEMPTS = 5
+FIRESTORE_RETRYABLE_ERRORS = (
+    google_exceptions.Aborted,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.ServiceUnavailable,
+)
 
 app = Flask(__name__)
 
@@ -48,253 +116,513 @@ sheets_service = None
 firestore_client = None
 polling_thread = None
 stop_polling = False
+poll_condition = threading.Condition()
+google_credentials = None
+scoped_credentials = {}  # 범위별 자격 증명 캐시 (클라이언트가 실제로 쓰는 객체)
+sheet_headers = None  # 시트 헤더 행 캐시
+# 마지막 처리 정보 캐시 (Firestore metadata/last_processed).
+# 이 프로세스만 체크포인트를 쓴다고 가정하므로 Cloud Run 인스턴스는 1개로 고정해 배포합니다 (--max-instances 1)
+last_processed_cache = None
+_credentials_lock = threading.Lock()
+_credentials_refresh_lock = threading.Lock()  # 네트워크 갱신 전용 (캐시 락과 분리)
+_poll_lock = threading.Lock()
+_sheets_service_lock = threading.Lock()
+_firestore_client_lock = threading.Lock()
+
+# Solapi 요청은 하나의 세션으로 보내 api.solapi.com과의 TLS 연결을 재사용합니다
+sms_session = requests.Session()
+# 어댑터에서는 요청이 전송되기 전인 연결 실패만 재시도합니다. 읽기 타임아웃 후 재전송하면
+# 이미 접수된 발송이 중복될 수 있고, 상태 코드 재시도는 인증 헤더를 새로 만들어야 하므로
+# post_sms_messages()에서 직접 처리합니다
+sms_session.mount('https://', HTTPAdapter(
+    pool_maxsize=SMS_SEND_WORKERS,
+    max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2)
+))
 
 @app.route('/')
 def home():
     return "Hello, World!"
 
+def loads_json(data):
+    """JSON 문자열을 파싱합니다. orjson이 있으면 orjson을 사용합니다."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps_json(obj):
+    """객체를 JSON 바이트열로 직렬화합니다. orjson이 있으면 orjson을 사용합니다."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+def get_credentials(scopes):
+    """Sheets/Firestore 클라이언트가 함께 쓰는 자격 증명을 반환합니다.
+
+    GCP_SA_KEY가 있으면 서비스 계정 키를 프로세스당 한 번만 파싱해 주어진 범위로 반환하고,
+    없으면 기본 자격 증명(ADC)을 두 API 범위를 모두 포함해 한 번만 조회해 공유합니다.
+    """
+    global google_credentials
+    if google_credentials is None:
+        with _credentials_lock:
+            if google_credentials is None:
+                try:
+                    if GCP_SA_KEY:
+                        google_credentials = service_account.Credentials.from_service_account_info(
+                            loads_json(GCP_SA_KEY)
+                        )
+                        logger.info("서비스 계정 자격 증명 초기화 완료")
+                    else:
+                        google_credentials, _ = google.auth.default(scopes=SHEETS_SCOPES + FIRESTORE_SCOPES)
+                        logger.info("기본 자격 증명(ADC) 초기화 완료")
+                except Exception as e:
+                    logger.error("자격 증명 초기화 실패: %s", e)
+                    raise
+    key = tuple(scopes)
+    if key not in scoped_credentials:
+        with _credentials_lock:
+            if key not in scoped_credentials:
+                credentials = google_credentials.with_scopes(scopes) if GCP_SA_KEY else google_credentials
+                # 만료가 가까운(STALE) 토큰은 요청을 막지 않고 google-auth의 백그라운드 스레드가 갱신합니다
+                credentials.with_non_blocking_refresh()
+                scoped_credentials[key] = credentials
+    return scoped_credentials[key]
+
+def refresh_credentials():
+    """이미 만료된 액세스 토큰을 미리 한 번만 갱신합니다.
+
+    병렬 커밋 스레드들이 같은 자격 증명을 동시에 갱신하지 않도록, 폴링 스레드가
+    병렬 작업을 시작하기 전에 갱신합니다. 네트워크 요청 동안 get_credentials가
+    막히지 않도록 캐시 락은 목록을 복사할 때만 잡고, 갱신은 전용 락으로 직렬화합니다.
+    곧 만료될 토큰은 사용 중에 백그라운드에서 갱신되므로 여기서는 기다리지 않습니다.
+    """
+    with _credentials_lock:
+        credentials_list = list(set(scoped_credentials.values()))
+    with _credentials_refresh_lock:
+        for credentials in credentials_list:
+            if credentials.token_state == TokenState.INVALID:
+                credentials.refresh(GoogleAuthRequest())
+
 def get_firestore_client():
-    """Firestore 클라이언트를 초기화합니다."""
+    """Firestore 클라이언트를 초기화합니다. 클라이언트는 프로세스당 한 번만 생성합니다."""
     global firestore_client
     if firestore_client is None:
-        try:
-            firestore_client = firestore.Client(
-                project='prism-fin',
-                database='sheet-sync'
-            )
-            logger.info("Firestore 클라이언트 초기화 완료")
-        except Exception as e:
-            logger.error(f"Firestore 클라이언트 초기화 실패: {e}")
-            raise
+        with _firestore_client_lock:
+            if firestore_client is None:
+                try:
+                    firestore_client = firestore.Client(
+                        project='prism-fin',
+                        database='sheet-sync',
+                        credentials=get_credentials(FIRESTORE_SCOPES)
+                    )
+                    logger.info("Firestore 클라이언트 초기화 완료")
+                except Exception as e:
+                    logger.error("Firestore 클라이언트 초기화 실패: %s", e)
+                    raise
     return firestore_client
 
 def get_sheets_service():
-    """Google Sheets API 서비스를 초기화합니다."""
+    """Google Sheets API 호출에 사용할 인증 세션을 초기화합니다.
+
+    values.batchGet 하나만 쓰므로 디스커버리 기반 클라이언트 대신 REST API를
+    AuthorizedSession으로 직접 호출합니다. 세션은 프로세스당 한 번만 만들어
+    폴링 주기마다 연결과 액세스 토큰을 재사용합니다.
+    """
     global sheets_service
     if sheets_service is None:
-        try:
-            sheets_service = build('sheets', 'v4')
-            logger.info("Google Sheets API 서비스 초기화 완료")
-        except Exception as e:
-            logger.error(f"Google Sheets API 서비스 초기화 실패: {e}")
-            raise
+        with _sheets_service_lock:
+            if sheets_service is None:
+                try:
+                    sheets_service = AuthorizedSession(get_credentials(SHEETS_SCOPES))
+                    # 429/5xx 응답은 지터를 섞은 지수 백오프로 재시도합니다 (Retry-After 헤더가 있으면 따름)
+                    sheets_service.mount('https://', HTTPAdapter(max_retries=Retry(
+                        total=SHEETS_MAX_RETRIES,
+                        backoff_factor=1,
+                        backoff_max=32,
+                        backoff_jitter=1,
+                        status_forcelist=[429, 500, 502, 503, 504],
+                        raise_on_status=False
+                    )))
+                    logger.info("Google Sheets API 서비스 초기화 완료")
+                except Exception as e:
+                    logger.error("Google Sheets API 서비스 초기화 실패: %s", e)
+                    raise
     return sheets_service
 
+def post_sms_messages(messages):
+    """Solapi 일괄 발송 API로 메시지를 보내고 응답을 반환합니다.
+
+    SDK의 send()는 호출마다 새 HTTP 클라이언트를 만들므로, 요청 본문과 인증 헤더만
+    SDK로 만들고 전송은 모듈 전역 세션(sms_session)으로 합니다.
+    """
+    body = dumps_json(SendMessageRequest(messages=messages).model_dump(exclude_none=True, by_alias=True))
+    for attempt in range(1, SOLAPI_MAX_ATTEMPTS + 1):
+        headers = {
+            # Solapi는 같은 salt의 서명을 거부하므로 재시도할 때도 서명을 새로 만듭니다
+            'Authorization': Authenticator(SOLAPI_API_KEY, SOLAPI_API_SECRET).get_auth_info(),
+            'Content-Type': 'application/json',
+        }
+        response = sms_session.post(SOLAPI_SEND_URL, headers=headers, data=body, timeout=SOLAPI_TIMEOUT)
+        if response.status_code not in SOLAPI_RETRYABLE_STATUSES or attempt == SOLAPI_MAX_ATTEMPTS:
+            break
+        retry_after = response.headers.get('Retry-After', '')
+        delay = min(float(retry_after), 30) if retry_after.isdigit() else 0.2 * 2 ** (attempt - 1)
+        logger.warning("Solapi 응답 %s, %s초 후 재시도 (%s/%s)", response.status_code, delay, attempt, SOLAPI_MAX_ATTEMPTS)
+        time.sleep(delay)
+    if 400 <= response.status_code < 500:
+        error = loads_json(response.content)
+        raise Exception(error.get('errorCode', 'UnknownError'), error.get('errorMessage', response.text))
+    response.raise_for_status()
+    return SendMessageResponse.model_validate(loads_json(response.content))
+
 def parse_korean_datetime(datetime_str):
-    """다양한 형식의 날짜 문자열을 datetime 객체로 변환합니다."""
-    formats = [
-        ('%Y. %m. %d 오전 %H:%M:%S', False),  # 2025. 6. 7 오전 10:41:17
-        ('%Y. %m. %d 오후 %H:%M:%S', True),   # 2025. 6. 7 오후 10:41:17
-        ('%Y-%m-%d %H:%M:%S', False),         # 2025-6-7 14:26:43
-        ('%Y-%m-%d %H:%M', False),            # 2025-6-7 14:26
-    ]
-    
-    for fmt, is_pm in formats:
-        try:
-            dt = datetime.strptime(datetime_str, fmt)
-            if is_pm and dt.hour < 12:
-                dt = dt.replace(hour=dt.hour + 12)
-            # 한국 시간대 적용
-            korea_tz = pytz.timezone('Asia/Seoul')
-            dt = korea_tz.localize(dt)
-            return dt
-        except ValueError:
-            continue
+    """다양한 형식의 날짜 문자열을 datetime 객체로 변환합니다.
+
+    지원 형식: '2025. 6. 7 오전 10:41:17', '2025. 6. 7 오후 10:41:17',
+    '2025-6-7 14:26:43', '2025-6-7 14:26'
+    """
+    match = _DATETIME_RE.fullmatch(datetime_str)
+    if not match:
+        raise ValueError(f"날짜 형식을 파싱할 수 없습니다: {datetime_str}")
     
-    raise ValueError(f"날짜 형식을 파싱할 수 없습니다: {datetime_str}")
+    year, month, day, meridiem, hour, minute, second = match.groups()
+    hour = int(hour)
+    if meridiem == '오후' and hour < 12:
+        hour += 12
+    # 한국 시간대 적용
+    return datetime(int(year), int(month), int(day), hour, int(minute), int(second or 0), tzinfo=KST)
 
-def send_sms(phone, name, inquiry):
-    """SMS를 발송합니다."""
-    try:
-        logger.info(f"SMS 전송 시작 - 수신자: {name}, 전화번호: {phone}")
-        
-        message_service = SolapiMessageService(
-            SOLAPI_API_KEY,
-            SOLAPI_API_SECRET
-        )
-        
-        text = f"""[포용적 금융서비스, 프리즘지점]
-{name}님, 만사형통 프리즘 부적 이벤트에 참여해주셔서 감사합니다! 
+def normalize_phone(phone):
+    """전화번호에서 숫자 외의 문자를 제거하고 국가번호(+82)를 국내 형식(0...)으로 바꿉니다.
 
-프리즘지점은 퀴어 당사자와 앨라이 보험설계사가 함께하는 보험 조직입니다. 모두를 위한 미래보장을 꿈꾸며, 금융의 경계를 넘어 연대합니다.
+    대부분의 입력은 ASCII이므로 str.translate 한 번으로 숫자 외의 문자를 지웁니다.
+    폼/시트 입력에 전각 숫자·하이픈이나 줄바꿈 없는 공백(NBSP)이 섞인 경우에만
+    NFKC 정규화로 ASCII로 바꾼 뒤, 남은 비ASCII 문자까지 제거합니다.
 
-선택해주신 프리즘지점에서, {inquiry} 문의에 반가운 마음을 전하며, 유용한 소식과 답변 안내드릴 수 있도록 곧 다시 연락드리겠습니다. 고맙습니다!
+    >>> normalize_phone('010\u00a01234\u00a05678')
+    '01012345678'
+    >>> normalize_phone('０１０－１２３４－５６７８')
+    '01012345678'
+    >>> normalize_phone('+82 10-1234-5678')
+    '01012345678'
+    """
+    if not phone.isascii():
+        phone = unicodedata.normalize('NFKC', phone)
+    digits = phone.translate(PHONE_STRIP_TABLE)
+    if not digits.isascii():
+        digits = re.sub(r'[^0-9]', '', digits)
+    if digits.startswith('82'):
+        digits = '0' + digits[2:].lstrip('0')
+    return digits
 
-프리즘지점 드림
-[보험상담 및 채용문의]
-https://litt.ly/prism.fin
+SOLAPI_SENDER_NUMBER = normalize_phone(SOLAPI_SENDER) if SOLAPI_SENDER else None  # 발신번호는 한 번만 정규화
 
-앞으로 소식은
-[인스타그램] 팔로우해주세요!
-www.instagram.com/prism.fin"""
-        logger.info(f"생성된 메시지 내용: {text}")
-        
-        # RequestMessage 모델 사용
-        message = RequestMessage(
-            from_=SOLAPI_SENDER,
-            to=phone,
-            text=text
-        )
-        
-        logger.info(f"SMS 전송 요청 데이터: {message.__dict__}")
+def build_sms_message(phone, name, inquiry):
+    """발송할 SMS 메시지를 생성합니다."""
+    text = SMS_TEMPLATE.format_map({'name': name, 'inquiry': inquiry})
+    logger.debug("생성된 메시지 내용: %s", text)
+    
+    # RequestMessage 모델 사용
+    return RequestMessage(
+        from_=SOLAPI_SENDER_NUMBER,
+        to=normalize_phone(phone),
+        text=text
+    )
+
+def send_sms_chunk(chunk):
+    """SMS 묶음 하나를 한 번의 요청으로 발송합니다. 모두 접수되면 True를 반환합니다."""
+    try:
+        logger.info("SMS 일괄 전송 시작: %s건", len(chunk))
         
         # SMS 전송 및 응답 대기
-        response = message_service.send(message)
-        logger.info(f"SMS 발송 결과: {response}")
+        response = post_sms_messages(chunk)
+        logger.debug("SMS 발송 결과: %s", response)
         
         # 전송 상태 확인
-        if response and hasattr(response, 'group_info'):
-            logger.info(f"Group ID: {response.group_info.group_id}")
-            logger.info(f"요청한 메시지 개수: {response.group_info.count.total}")
-            logger.info(f"성공한 메시지 개수: {response.group_info.count.registered_success}")
-            logger.info(f"실패한 메시지 개수: {response.group_info.count.registered_failed}")
-            
-            # 전송 실패 시 예외 발생
-            if response.group_info.count.registered_failed > 0:
-                raise Exception(f"SMS 전송 실패: {response.group_info.count.registered_failed}건 실패")
-            
-            logger.info(f"SMS 전송 완료 - 수신자: {name}, 전화번호: {phone}")
-            return True
-        else:
+        if not response or not hasattr(response, 'group_info'):
             raise Exception("SMS 전송 응답이 올바르지 않습니다")
-            
+        
+        count = response.group_info.count
+        logger.info("Group ID: %s", response.group_info.group_id)
+        logger.info("요청한 메시지 개수: %s", count.total)
+        logger.info("성공한 메시지 개수: %s", count.registered_success)
+        logger.info("실패한 메시지 개수: %s", count.registered_failed)
+        
+        if count.registered_failed > 0:
+            for failed in response.failed_message_list or []:
+                logger.error("SMS 전송 실패 - 전화번호: %s, 사유: %s", failed.to, failed.status_message)
+            return False
+        return True
+        
     except Exception as e:
-        logger.error(f"SMS 발송 실패: {e}")
+        logger.error("SMS 발송 실패 (%s건): %s", len(chunk), e)
         return False
 
-def poll_sheet():
+def send_sms_bulk(messages):
+    """여러 SMS를 SMS_BATCH_SIZE건씩 묶어 발송합니다.
+
+    묶음이 여러 개면 스레드 풀에서 동시에 발송합니다.
+    모든 메시지가 접수되면 True, 한 건이라도 실패하면 False를 반환합니다.
+    """
+    chunks = [messages[start:start + SMS_BATCH_SIZE] for start in range(0, len(messages), SMS_BATCH_SIZE)]
+    if len(chunks) <= 1:
+        return all(send_sms_chunk(chunk) for chunk in chunks)
+    
+    with ThreadPoolExecutor(max_workers=min(SMS_SEND_WORKERS, len(chunks))) as executor:
+        results = list(executor.map(send_sms_chunk, chunks))
+    return all(results)
+
+def send_sms(phone, name, inquiry):
+    """SMS를 한 건 발송합니다."""
+    logger.info("SMS 전송 시작 - 수신자: %s, 전화번호: %s", name, phone)
+    return send_sms_bulk([build_sms_message(phone, name, inquiry)])
+
+class RateLimiter:
+    """토큰 버킷 방식의 스레드 안전한 클라이언트 측 속도 제한기."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate  # 초당 보충되는 토큰 수
+        self.capacity = capacity  # 한 번에 쓸 수 있는 최대 토큰 수 (버스트)
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n=1):
+        """토큰 n개를 확보할 때까지 대기합니다."""
+        n = min(n, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Firestore 쓰기는 초당 10,000건(버스트 5,000건), Sheets 읽기는 분당 300회로 제한합니다
+firestore_write_limiter = RateLimiter(rate=10000, capacity=5000)
+sheets_read_limiter = RateLimiter(rate=300 / 60, capacity=10)
+
+def commit_with_retry(batch, ops=FIRESTORE_BATCH_LIMIT, max_attempts=FIRESTORE_COMMIT_MAX_ATTEMPTS):
+    """Firestore 배치를 커밋하고, 일시적인 오류는 지수 백오프로 재시도합니다."""
+    for attempt in range(1, max_attempts + 1):
+        firestore_write_limiter.acquire(ops)
+        try:
+            return batch.commit()
+        except FIRESTORE_RETRYABLE_ERRORS as e:
+            if attempt == max_attempts:
+                raise
+            delay = min(2 ** (attempt - 1), 16) * 0.5
+            logger.warning("Firestore 배치 커밋 재시도 (%s/%s), %s초 후: %s", attempt, max_attempts, delay, e)
+            time.sleep(delay)
+
+def commit_batches(batches):
+    """여러 Firestore 배치를 스레드 풀에서 병렬로 커밋합니다."""
+    workers = min(FIRESTORE_COMMIT_WORKERS, len(batches))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list()로 결과를 모두 소비해 어느 하나라도 실패하면 예외가 전파되도록 합니다
+        list(executor.map(commit_with_retry, batches))
+    logger.info("Firestore 배치 %s개 병렬 커밋 완료", len(batches))
+
+def a1_range(sheet_name, cells):
+    """시트 이름과 셀 범위로 A1 표기법 범위 문자열을 만듭니다."""
+    quoted_name = sheet_name.replace("'", "''")
+    return f"'{quoted_name}'!{cells}"
+
+def poll_sheet(sheets=None, db=None):
     """Google Sheets 데이터를 폴링하고 Firestore에 저장합니다."""
+    global sheet_headers, last_processed_cache
     try:
         logger.info("Google Sheets 데이터 확인 시작")
-        sheets = get_sheets_service()
-        db = get_firestore_client()
-        
-        # 스프레드시트 ID와 시트 이름을 환경 변수에서 가져옵니다.
-        spreadsheet_id = os.getenv('SPREADSHEET_ID')
-        sheet_name = os.getenv('SHEET_NAME')
-        
-        if not spreadsheet_id or not sheet_name:
-            raise ValueError("SPREADSHEET_ID 또는 SHEET_NAME 환경 변수가 설정되지 않았습니다.")
+        sheets = sheets or get_sheets_service()
+        db = db or get_firestore_client()
+        refresh_credentials()
         
-        logger.info(f"스프레드시트 확인 중: ID={spreadsheet_id}, 시트={sheet_name}")
+        logger.info("스프레드시트 확인 중: ID=%s, 시트=%s", SPREADSHEET_ID, SHEET_NAME)
         
-        # 마지막으로 처리된 정보를 Firestore에서 가져옵니다
+        # 마지막으로 처리된 정보는 메모리 캐시를 우선 사용하고, 없을 때만 Firestore에서 가져옵니다
         last_processed_ref = db.collection('metadata').document('last_processed')
-        last_processed_doc = last_processed_ref.get()
-        last_processed = {
-            'timestamp': last_processed_doc.get('timestamp') if last_processed_doc.exists else None,
-            'row_number': last_processed_doc.get('row_number') if last_processed_doc.exists and 'row_number' in last_processed_doc.to_dict() else 0
-        }
+        if last_processed_cache is None:
+            last_processed_doc = last_processed_ref.get()
+            last_processed_cache = {
+                'timestamp': last_processed_doc.get('timestamp') if last_processed_doc.exists else None,
+                'row_number': last_processed_doc.get('row_number') if last_processed_doc.exists and 'row_number' in last_processed_doc.to_dict() else 0
+            }
+            logger.info("Firestore에서 마지막 처리 정보를 불러왔습니다.")
+        last_processed = last_processed_cache
+        
+        logger.info("마지막으로 처리된 정보: 타임스탬프=%s, 행 번호=%s", last_processed['timestamp'], last_processed['row_number'])
         
-        logger.info(f"마지막으로 처리된 정보: 타임스탬프={last_processed['timestamp']}, 행 번호={last_processed['row_number']}")
+        # Google Sheets API를 사용하여 마지막으로 처리된 행 이후의 데이터만 가져옵니다.
+        # 헤더 행은 처음 한 번만 같은 batchGet 요청으로 함께 읽고 캐시합니다.
+        start_row = last_processed['row_number'] + 1 if last_processed['row_number'] else 2
+        ranges = [a1_range(SHEET_NAME, f"A{start_row}:{SHEET_LAST_COLUMN}")]
+        if sheet_headers is None:
+            ranges.insert(0, a1_range(SHEET_NAME, f"A1:{SHEET_LAST_COLUMN}1"))
         
-        # Google Sheets API를 사용하여 데이터를 가져옵니다.
-        logger.info("Google Sheets API 호출 시작")
-        result = sheets.spreadsheets().values().get(
-            spreadsheetId=spreadsheet_id,
-            range=sheet_name
-        ).execute()
+        logger.info("Google Sheets API 호출 시작: %s", ranges)
+        sheets_read_limiter.acquire()
+        response = sheets.get(
+            f"{SHEETS_API_URL}/{SPREADSHEET_ID}/values:batchGet",
+            # 응답에서 값 배열만 받도록 필드 마스크를 지정합니다 (range 등 메타데이터 제외)
+            params={'ranges': ranges, 'fields': 'valueRanges(values)'},
+            timeout=SHEETS_TIMEOUT
+        )
+        response.raise_for_status()
+        result = loads_json(response.content)
         logger.info("Google Sheets API 호출 완료")
         
-        values = result.get('values', [])
+        value_ranges = result.get('valueRanges', [])
+        headers_from_cache = sheet_headers is not None
+        if not headers_from_cache:
+            header_values = value_ranges[0].get('values', []) if value_ranges else []
+            if not header_values:
+                logger.warning("데이터가 없습니다.")
+                return
+            sheet_headers = header_values[0]
+        data_rows = value_ranges[-1].get('values', []) if value_ranges else []
         
-        if not values:
-            logger.warning("데이터가 없습니다.")
-            return
+        logger.info("시트에서 %s행부터 %s행의 데이터를 가져왔습니다.", start_row, len(data_rows))
         
-        logger.info(f"시트에서 총 {len(values)}행의 데이터를 가져왔습니다.")
+        # 캐시된 헤더보다 긴 행이 있으면 컬럼이 추가됐을 수 있으므로 다음 폴링에서 헤더를 다시 읽습니다.
+        # 헤더를 방금 읽은 경우에는 제목 없는 컬럼에 입력된 값일 뿐이므로 남는 셀을 무시하고 계속 처리합니다
+        # (Sheets는 헤더 행 끝의 빈 셀을 잘라서 반환합니다)
+        headers = sheet_headers
+        if any(len(row) > len(headers) for row in data_rows):
+            if headers_from_cache:
+                logger.warning("헤더보다 긴 행이 있어 다음 폴링에서 헤더를 다시 읽습니다.")
+                sheet_headers = None
+                return
+            logger.warning("헤더보다 긴 행이 있어 제목 없는 컬럼의 값은 무시합니다.")
         
-        # 헤더 행을 가져와서 컬럼 인덱스 매핑
-        headers = values[0]
+        # 헤더 행에서 컬럼 인덱스 매핑
         phone_idx = headers.index('연락처 / Phone Number') if '연락처 / Phone Number' in headers else -1
         name_idx = headers.index('이름(혹은 닉네임) /  Name or nickname') if '이름(혹은 닉네임) /  Name or nickname' in headers else -1
         
         if phone_idx == -1 or name_idx == -1:
             logger.error("필수 컬럼을 찾을 수 없습니다.")
+            sheet_headers = None
             return
             
-        logger.info(f"컬럼 매핑 - 전화번호: {phone_idx}, 이름: {name_idx}")
+        logger.info("컬럼 매핑 - 전화번호: %s, 이름: %s", phone_idx, name_idx)
         
-        # 헤더 행을 제외하고 데이터 처리
-        data_rows = values[1:] if len(values) > 1 else []
-        logger.info(f"헤더를 제외한 데이터 행 수: {len(data_rows)}")
-        
-        # 새로운 데이터만 처리
+        # 새로운 데이터만 처리: 시트는 행이 뒤에 추가되기만 하므로 마지막 처리 행 번호보다 큰 행이 새 행입니다.
+        # 타임스탬프가 같거나 순서가 뒤바뀐 행도 누락되지 않도록, 행 번호가 없는 이전 체크포인트에서만
+        # (타임스탬프, 행 번호) 비교를 사용합니다
+        threshold = (last_processed['timestamp'] or MIN_TIMESTAMP, last_processed['row_number'])
         new_rows = []
-        for i, row in enumerate(data_rows, start=2):  # 2부터 시작 (헤더가 1행)
+        for i, row in enumerate(data_rows, start=start_row):
+            # 이미 처리된 행은 타임스탬프를 파싱하기 전에 건너뜁니다
+            if i <= last_processed['row_number']:
+                continue
             if len(row) > max(phone_idx, name_idx):  # 필요한 컬럼이 모두 있는지 확인
                 try:
                     row_timestamp = parse_korean_datetime(row[0])
-                    # 타임스탬프가 같거나 더 크고, 행 번호가 더 큰 경우에만 처리
-                    if (last_processed['timestamp'] is None or 
-                        row_timestamp > last_processed['timestamp'] or 
-                        (row_timestamp == last_processed['timestamp'] and i > last_processed['row_number'])):
+                    if last_processed['row_number'] or (row_timestamp, i) > threshold:
                         new_rows.append((row, row_timestamp, i))
                 except ValueError as e:
-                    logger.warning(f"타임스탬프 파싱 실패: {row[0]}, {e}")
+                    logger.warning("타임스탬프 파싱 실패: %s, %s", row[0], e)
                     continue
         
         if not new_rows:
             logger.info("새로운 데이터가 없습니다.")
             return
             
-        logger.info(f"새로운 데이터 {len(new_rows)}행 발견")
+        logger.info("새로운 데이터 %s행 발견", len(new_rows))
         
-        # 데이터를 Firestore에 저장하고 SMS 전송
-        latest_processed = {'timestamp': None, 'row_number': 0}
+        # 데이터를 배치로 Firestore에 저장 (배치당 최대 FIRESTORE_BATCH_LIMIT건)
+        # 문서 ID를 타임스탬프와 행 번호로 고정해 커밋을 재시도해도 중복 저장되지 않습니다
+        latest = None
+        full_batches = []
+        batch = db.batch()
+        batch_size = 0
         for row, row_timestamp, row_number in new_rows:
-            try:
-                # Firestore에 저장
-                doc_ref = db.collection('sheet_data').document()
-                doc_ref.set({
-                    'timestamp': row[0],
-                    'phone': row[phone_idx],
-                    'name': row[name_idx],
-                    'row_number': row_number,
-                    'processed_at': firestore.SERVER_TIMESTAMP
-                })
-                logger.info(f"행 처리 완료: {row[0]}, {row[name_idx]}, 행 번호: {row_number}")
-                
-                # SMS 전송 시도
-                logger.info(f"SMS 전송 시도: {row[name_idx]}")
-                send_sms(row[phone_idx], row[name_idx], '프리즘지점에서,')
-                logger.info(f"SMS 전송 성공: {row[name_idx]}")
-                
-                # 마지막 처리 정보 업데이트
-                if (latest_processed['timestamp'] is None or 
-                    row_timestamp > latest_processed['timestamp'] or 
-                    (row_timestamp == latest_processed['timestamp'] and row_number > latest_processed['row_number'])):
-                    latest_processed = {'timestamp': row_timestamp, 'row_number': row_number}
-                
-            except Exception as e:
-                logger.error(f"행 처리 중 오류 발생: {row}, 오류: {e}")
-                continue
-        
-        # 마지막으로 처리된 정보 업데이트
-        if latest_processed['timestamp']:
-            last_processed_ref.set({
-                'timestamp': latest_processed['timestamp'],
-                'row_number': latest_processed['row_number'],
-                'last_updated': firestore.SERVER_TIMESTAMP
+            doc_id = f"{row_timestamp.strftime('%Y%m%d%H%M%S')}-{row_number}"
+            batch.set(db.collection('sheet_data').document(doc_id), {
+                'timestamp': row_timestamp,
+                'phone': row[phone_idx],
+                'name': row[name_idx],
+                'row_number': row_number,
+                'processed_at': firestore.SERVER_TIMESTAMP
             })
-            logger.info(f"마지막 처리 정보 업데이트: 타임스탬프={latest_processed['timestamp']}, 행 번호={latest_processed['row_number']}")
+            batch_size += 1
+            if batch_size == FIRESTORE_BATCH_LIMIT:
+                full_batches.append(batch)
+                batch = db.batch()
+                batch_size = 0
+            
+            # 마지막 처리 정보 업데이트 (new_rows는 행 번호 순이므로 마지막 행이 체크포인트가 됩니다)
+            latest = (row_timestamp, row_number)
+        
+        latest_processed = {'timestamp': latest[0], 'row_number': latest[1]}
+        
+        # 가득 찬 배치들은 병렬로 커밋합니다
+        if full_batches:
+            commit_batches(full_batches)
+        
+        # 마지막으로 처리된 정보는 남은 행과 같은 배치로, 나머지 배치가 모두 성공한 뒤에 커밋합니다
+        batch.set(last_processed_ref, {
+            'timestamp': latest_processed['timestamp'],
+            'row_number': latest_processed['row_number'],
+            'last_updated': firestore.SERVER_TIMESTAMP
+        })
+        commit_with_retry(batch, batch_size + 1)
+        last_processed_cache = latest_processed
+        logger.info("Firestore 배치 커밋 완료: %s건", batch_size)
+        logger.info("마지막 처리 정보 업데이트: 타임스탬프=%s, 행 번호=%s", latest_processed['timestamp'], latest_processed['row_number'])
         
-        logger.info(f"데이터 처리 완료. 총 {len(new_rows)}개의 새로운 행이 처리되었습니다.")
+        # 저장이 끝난 행에 대해서만 SMS를 일괄 전송
+        messages = [
+            build_sms_message(row[phone_idx], row[name_idx], '프리즘지점에서,')
+            for row, row_timestamp, row_number in new_rows
+        ]
+        if send_sms_bulk(messages):
+            logger.info("SMS 전송 성공: %s건", len(messages))
+        
+        logger.info("데이터 처리 완료. 총 %s개의 새로운 행이 처리되었습니다.", len(new_rows))
         
     except Exception as e:
-        logger.error(f"데이터 폴링 중 오류 발생: {e}")
+        logger.error("데이터 폴링 중 오류 발생: %s", e)
+        # 다음 폴링에서는 Firestore를 기준으로 마지막 처리 정보를 다시 읽습니다
+        last_processed_cache = None
         raise
 
+def run_poll(sheets=None, db=None, blocking=False):
+    """폴링이 겹치지 않도록 _poll_lock을 잡고 poll_sheet를 실행합니다.
+
+    blocking이 False이면 다른 스레드에서 이미 폴링 중일 때 기다리지 않고 False를 반환하고,
+    True이면 진행 중인 폴링이 끝날 때까지 기다린 뒤 실행합니다.
+    """
+    if not _poll_lock.acquire(blocking=blocking):
+        logger.info("이미 폴링이 진행 중이어서 이번 폴링은 건너뜁니다.")
+        return False
+    try:
+        poll_sheet(sheets, db)
+        return True
+    finally:
+        _poll_lock.release()
+
 def polling_worker():
-    """백그라운드에서 지속적으로 시트 데이터를 확인하는 워커 함수"""
-    global stop_polling
+    """백그라운드에서 시트 데이터를 확인하는 대체 워커 함수
+
+    POLLING_INTERVAL초마다 시트를 확인합니다. Cloud Run에서는 요청이 없을 때 CPU가
+    제한될 수 있으므로 주 처리 경로는 /poll 요청 안에서 실행되는 폴링입니다.
+    """
+    sheets = None
+    db = None
     while not stop_polling:
         try:
-            poll_sheet()
-            time.sleep(1)  # 1초 대기
+            # 클라이언트는 한 번만 만들고 이후 폴링에서 그대로 재사용합니다
+            sheets = sheets or get_sheets_service()
+            db = db or get_firestore_client()
+            run_poll(sheets, db)
         except Exception as e:
-            logger.error(f"폴링 워커에서 오류 발생: {e}")
-            time.sleep(1)  # 오류 발생 시에도 1초 대기
+            logger.error("폴링 워커에서 오류 발생: %s", e)
+        
+        # 중지 신호가 오거나 대체 폴링 주기가 지날 때까지 대기
+        with poll_condition:
+            poll_condition.wait_for(lambda: stop_polling, timeout=POLLING_INTERVAL)
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -303,16 +631,27 @@ def health_check():
 
 @app.route('/poll', methods=['POST'])
 def trigger_poll():
-    """수동으로 폴링을 트리거하는 엔드포인트"""
+    """폴링을 트리거하는 엔드포인트 (시트의 폼 제출 트리거, Cloud Scheduler가 호출)
+
+    Cloud Run은 요청을 처리하는 동안에만 CPU를 보장하므로 폴링을 요청 안에서 실행합니다.
+    이미 폴링이 진행 중이면 그 폴링이 끝날 때까지 기다린 뒤 이 요청에서 한 번 더 확인해,
+    진행 중인 폴링 이후에 들어온 행도 이 요청 안에서 처리합니다.
+    """
     try:
-        poll_sheet()
+        run_poll(blocking=True)
         return jsonify({"status": "success", "message": "폴링이 성공적으로 완료되었습니다."}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+def validate_config():
+    """폴링에 필요한 환경 변수가 설정되어 있는지 확인합니다."""
+    if not SPREADSHEET_ID or not SHEET_NAME:
+        raise ValueError("SPREADSHEET_ID 또는 SHEET_NAME 환경 변수가 설정되지 않았습니다.")
+
 def start_polling():
     """폴링 스레드를 시작합니다."""
     global polling_thread, stop_polling
+    validate_config()
     stop_polling = False
     polling_thread = threading.Thread(target=polling_worker)
     polling_thread.daemon = True  # 메인 스레드가 종료되면 함께 종료되도록 설정
@@ -321,8 +660,10 @@ def start_polling():
 
 def stop_polling_thread():
     """폴링 스레드를 중지합니다."""
-    global stop_polling, polling_thread
-    stop_polling = True
+    global stop_polling
+    with poll_condition:
+        stop_polling = True
+        poll_condition.notify()
     if polling_thread and polling_thread.is_alive():
         polling_thread.join()
         logger.info("폴링 스레드가 중지되었습니다.")
@@ -331,129 +672,16 @@ def stop_polling_thread():
 with app.app_context():
     start_polling()
 
-@app.teardown_appcontext
-def cleanup(exception=None):
-    """애플리케이션 컨텍스트가 종료될 때 정리 작업을 수행합니다."""
-    stop_polling_thread()
-
-def init_google_client():
-    try:
-#        credentials_dict = json.loads(GOOGLE_CREDENTIALS)
-#        credentials = service_account.Credentials.from_service_account_info(
-#            credentials_dict,
-#            scopes=['https://www.googleapis.com/auth/spreadsheets.readonly']
-#        )
-        service = build('sheets', 'v4')#, credentials=credentials)
-        return service
-    except Exception as e:
-        logger.error(f"Google API 클라이언트 초기화 실패: {str(e)}")
-        raise
-
-def init_firestore_client():
-    try:
-#        credentials_dict = json.loads(GOOGLE_CREDENTIALS)
-#        credentials = service_account.Credentials.from_service_account_info(
-#            credentials_dict
-#        )
-        db = firestore.Client()#credentials=credentials)
-        return db
-    except Exception as e:
-        logger.error(f"Firestore 클라이언트 초기화 실패: {str(e)}")
-        raise
-
-def init_solapi_client():
-    try:
-        return SolapiMessageService(SOLAPI_API_KEY, SOLAPI_API_SECRET)
-    except Exception as e:
-        logger.error(f"Solapi 클라이언트 초기화 실패: {str(e)}")
-        raise
-
-def get_sheet_data(service):
-    try:
-        if not SPREADSHEET_ID:
-            raise ValueError("SPREADSHEET_ID가 설정되지 않았습니다.")
-            
-        range_name = f"{SHEET_NAME}!{RANGE}"
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=range_name
-        ).execute()
-        return result.get('values', [])
-    except Exception as e:
-        logger.error(f"Google Sheet 데이터 가져오기 실패: {str(e)}")
-        raise
-
-def save_to_firestore(db, data):
-    try:
-        batch = db.batch()
-        collection_ref = db.collection('sheet_data')
-        
-        for row in data:
-            if len(row) >= 2:  # 최소한 timestamp와 value가 있는지 확인
-                timestamp_str = row[0]
-                value = row[1]
-                
-                try:
-                    # 타임스탬프 파싱
-                    timestamp = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-                    
-                    # 문서 ID 생성 (타임스탬프 기반)
-                    doc_id = timestamp.strftime('%Y%m%d%H%M%S')
-                    
-                    # 문서 데이터 준비
-                    doc_data = {
-                        'timestamp': timestamp,
-                        'value': value,
-                        'created_at': firestore.SERVER_TIMESTAMP
-                    }
-                    
-                    # 배치에 추가
-                    doc_ref = collection_ref.document(doc_id)
-                    batch.set(doc_ref, doc_data)
-                    
-                except ValueError as e:
-                    logger.warning(f"잘못된 타임스탬프 형식: {timestamp_str}, 오류: {str(e)}")
-                    continue
-        
-        # 배치 커밋
-        batch.commit()
-        logger.info(f"Firestore에 {len(data)}개의 데이터 저장 완료")
-        
-    except Exception as e:
-        logger.error(f"Firestore 데이터 저장 실패: {str(e)}")
-        raise
-
-def check_and_send_sms(db, solapi_client, last_check_time):
-    try:
-        # 마지막 체크 이후의 데이터 조회
-        query = db.collection('sheet_data').where('created_at', '>', last_check_time)
-        new_docs = query.stream()
-        
-        for doc in new_docs:
-            data = doc.to_dict()
-            message = f"새로운 데이터가 추가되었습니다:\n시간: {data['timestamp'].strftime('%Y-%m-%d %H:%M:%S')}\n값: {data['value']}"
-            
-            try:
-                solapi_client.send_message({
-                    'to': RECIPIENT_PHONE_NUMBER,
-                    'from': SOLAPI_SENDER,
-                    'text': message
-                })
-                logger.info(f"SMS 전송 성공: {message}")
-            except Exception as e:
-                logger.error(f"SMS 전송 실패: {str(e)}")
-                
-    except Exception as e:
-        logger.error(f"새 데이터 확인 및 SMS 전송 실패: {str(e)}")
-        raise
+# 요청마다 호출되는 teardown_appcontext 대신 프로세스 종료 시 폴링 스레드를 정리합니다
+atexit.register(stop_polling_thread)
 
 def main():
     """메인 함수"""
     try:
         logger.info("프로그램 시작")
-        poll_sheet()
+        run_poll()
     except Exception as e:
-        logger.error(f"프로그램 실행 중 오류 발생: {e}")
+        logger.error("프로그램 실행 중 오류 발생: %s", e)
         raise
 
 if __name__ == '__main__':